@@ -10,10 +10,19 @@ http://appr.org.br:8901/
 """
 
 from .context import tncexporter
+from .packets import utah_packets_agw, brazil_packets_agw, germany_packets_agw, \
+    taiwan_packets_agw
+from tncexporter.metrics import PACKET_RX, RX_PACKET_SIZE, PACKET_DISTANCE, \
+    MAX_DISTANCE_RECENT, PACKET_RX_RECENT_PATH, PACKET_RX_RECENT_FRAME
+from aioprometheus.collectors import Collector
 import asyncio
+import collections
 import pytest
 import sys
 
+# location of the TNC used for distance metrics in tests
+TNC_LOCATION = (40.5, -111.9)
+
 
 def setup_env():
     """Setup function for running async subprocesses"""
@@ -22,6 +31,52 @@ def setup_env():
             asyncio.WindowsProactorEventLoopPolicy())
 
 
+@pytest.fixture
+def exporter():
+    """TNCExporter that isn't started, with all metrics cleared before the test"""
+    for name in dir(tncexporter.metrics):
+        metric = getattr(tncexporter.metrics, name)
+        if isinstance(metric, Collector):
+            metric.values.clear()
+    # the prometheus service used by the exporter needs an event loop when it is created
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    tnc_exporter = tncexporter.exporter.TNCExporter(tnc_url="http://127.0.0.1:8000",
+                                                    stats_interval=1,
+                                                    receiver_location=TNC_LOCATION,
+                                                    loop=loop)
+    yield tnc_exporter
+    tnc_exporter.parse_executor.shutdown()
+    asyncio.set_event_loop(None)
+    loop.close()
+
+
+def parse_test_packets() -> list:
+    """Parse all AGW packets in tests/packets.py into PacketInfo objects"""
+    return [tncexporter.parser.PacketInfo(p) for p in utah_packets_agw + brazil_packets_agw
+            + germany_packets_agw + taiwan_packets_agw]
+
+
+class QueueListener(tncexporter.listener.Listener):
+    """Listener that doesn't connect to a TNC, with packets added to its queue by the test"""
+    def __init__(self):
+        self.packet_queue = collections.deque()
+        self.packets_ready = asyncio.Event()
+
+    def put(self, packets: list):
+        """Add packets to the queue and wake up the exporter, as when they are received"""
+        self.packet_queue.extend(packets)
+        self.packets_ready.set()
+
+
+async def wait_until(condition, timeout: float = 5):
+    """Wait for the exporter's tasks to make condition() true"""
+    async def poll():
+        while not condition():
+            await asyncio.sleep(0.01)
+    await asyncio.wait_for(poll(), timeout)
+
+
 async def run(cmd):
     """asynchronously run a subprocess, useful for running tncexporter in tests"""
     proc = await asyncio.create_subprocess_shell(
@@ -49,4 +104,156 @@ class TestExporterCreation:
         setup_env()
         asyncio.run(test_help_message())
 
+    def test_invalid_distance_method(self):
+        """Check that an unknown distance method is rejected when the exporter is created"""
+        with pytest.raises(ValueError):
+            tncexporter.exporter.TNCExporter(tnc_url="http://127.0.0.1:8000",
+                                             receiver_location=TNC_LOCATION,
+                                             distance_method='manhattan')
+
+    @pytest.mark.parametrize('stats_interval', [0, -30])
+    def test_invalid_stats_interval(self, stats_interval):
+        """Check that a stats interval that isn't positive is rejected when the exporter is
+        created"""
+        with pytest.raises(ValueError):
+            tncexporter.exporter.TNCExporter(tnc_url="http://127.0.0.1:8000",
+                                             stats_interval=stats_interval)
+
+    def test_update_interval_argument(self):
+        """Check that an update interval of 0 is rejected by the command line parser"""
+
+        async def test_zero_interval():
+            result = await run('python -m tncexporter --update-interval 0')
+            assert "must be a positive integer" in result
+
+        setup_env()
+        asyncio.run(test_zero_interval())
+
     # TODO: add integration tests of connection to AGW and KISS interfaces
+
+
+class TestPacketMetrics:
+    """Test that metrics are updated from batches of packets"""
+
+    def test_packet_metrics_batch(self, exporter):
+        packets = parse_test_packets()
+        rx_counts = collections.Counter()
+        observations = collections.defaultdict(list)
+        for packet in packets:
+            exporter.packet_metrics(packet, rx_counts, observations)
+        exporter.packet_rx_metrics(rx_counts)
+        exporter.packet_histogram_metrics(observations)
+
+        received = [p for p in packets if p.frame_type != 'T']
+        expected_rx = collections.Counter(
+            (p.frame_type, 'Digipeated' if p.hops_count > 0 else 'Simplex', p.call_from)
+            for p in received)
+        assert len(PACKET_RX.values) == len(expected_rx)
+        for (frame_type, path, call_from), count in expected_rx.items():
+            assert PACKET_RX.get({'ax25_frame_type': frame_type,
+                                  'path': path,
+                                  'from_cs': call_from}) == count
+
+        rx_size = RX_PACKET_SIZE.get({})
+        assert rx_size['count'] == len(received)
+        assert rx_size['sum'] == sum(p.len_data for p in received)
+
+        distances = [p.haversine_distance(TNC_LOCATION) for p in received
+                     if p.lat_rad is not None]
+        assert distances
+        packet_distance = PACKET_DISTANCE.get({'type': 'unknown'})
+        assert packet_distance['count'] == len(distances)
+        assert packet_distance['sum'] == pytest.approx(sum(distances))
+
+
+class TestExporterTasks:
+    """Test the packet_consumer and metric_updater tasks of the exporter"""
+
+    def test_consumer_and_updater(self, exporter):
+        raw_packets = utah_packets_agw + brazil_packets_agw + germany_packets_agw \
+            + taiwan_packets_agw
+        received = [p for p in parse_test_packets() if p.frame_type != 'T']
+        simplex = [p for p in received if p.hops_count == 0]
+        max_distance = {path: max(p.haversine_distance(TNC_LOCATION) for p in packets
+                                  if p.lat_rad is not None)
+                        for path, packets in (('Simplex', simplex),
+                                              ('Digipeated', [p for p in received
+                                                              if p.hops_count > 0]))}
+        labels = exporter.distance_labels
+        all_frames = exporter.frame_labels['All']
+        all_paths = exporter.path_labels['All']
+        simplex_path = exporter.path_labels['Simplex']
+
+        async def run_tasks():
+            exporter.listener = QueueListener()
+            consumer = asyncio.create_task(exporter.packet_consumer())
+            exporter.listener.put(raw_packets)
+            # the consumer takes all packets from the queue, parses them and updates metrics
+            await wait_until(lambda: len(exporter.interval_packets) == len(raw_packets))
+            assert not exporter.listener.packet_queue
+            assert not exporter.listener.packets_ready.is_set()
+            assert sum(PACKET_RX.values.values()) == len(received)
+            assert exporter.max_distance == pytest.approx(max_distance)
+
+            # the first summary update runs as soon as the updater starts, taking the packets
+            # processed by the consumer
+            updater = asyncio.create_task(exporter.metric_updater())
+            await wait_until(lambda: not exporter.interval_packets)
+            assert MAX_DISTANCE_RECENT.get(labels['Simplex']) == \
+                pytest.approx(max_distance['Simplex'])
+            assert MAX_DISTANCE_RECENT.get(labels['Digipeated']) == \
+                pytest.approx(max_distance['Digipeated'])
+            assert PACKET_RX_RECENT_FRAME.get(all_frames) == len(received)
+            assert PACKET_RX_RECENT_PATH.get(all_paths) == len(received)
+            assert PACKET_RX_RECENT_PATH.get(simplex_path) == len(simplex)
+            assert exporter.max_distance == {'Simplex': 0.0, 'Digipeated': 0.0}
+
+            # no packets are received in the next interval, so the metrics are reset to 0
+            await asyncio.sleep(1.2)
+            assert MAX_DISTANCE_RECENT.get(labels['Simplex']) == 0
+            assert MAX_DISTANCE_RECENT.get(labels['Digipeated']) == 0
+            assert PACKET_RX_RECENT_FRAME.get(all_frames) == 0
+            assert PACKET_RX_RECENT_PATH.get(all_paths) == 0
+
+            # after another interval with no packets, the update is skipped as the metrics are
+            # already 0
+            MAX_DISTANCE_RECENT.set(labels['Simplex'], 1.0)
+            await asyncio.sleep(1.0)
+            assert MAX_DISTANCE_RECENT.get(labels['Simplex']) == 1.0
+
+            consumer.cancel()
+            updater.cancel()
+            await asyncio.gather(consumer, updater, return_exceptions=True)
+
+        exporter.loop.run_until_complete(run_tasks())
+
+    def test_consumer_metrics_error(self, exporter, monkeypatch):
+        """Check that the consumer keeps running after an error updating metrics for a batch"""
+        received = [tncexporter.parser.PacketInfo(p) for p in utah_packets_agw]
+        received = [p for p in received if p.frame_type != 'T']
+        packet_histogram_metrics = exporter.packet_histogram_metrics
+        batches = []
+
+        def fail_first_batch(observations):
+            batches.append(observations)
+            if len(batches) == 1:
+                raise TypeError("Histogram only works with digits (int, float)")
+            packet_histogram_metrics(observations)
+
+        monkeypatch.setattr(exporter, 'packet_histogram_metrics', fail_first_batch)
+
+        async def run_consumer():
+            exporter.listener = QueueListener()
+            consumer = asyncio.create_task(exporter.packet_consumer())
+            exporter.listener.put(utah_packets_agw)
+            await wait_until(lambda: len(batches) == 1)
+            assert not consumer.done()
+            # the packets of the failed batch are not kept for the summary metrics
+            assert not exporter.interval_packets
+            exporter.listener.put(utah_packets_agw)
+            await wait_until(lambda: len(exporter.interval_packets) == len(utah_packets_agw))
+            assert RX_PACKET_SIZE.get({})['count'] == len(received)
+            consumer.cancel()
+            await asyncio.gather(consumer, return_exceptions=True)
+
+        exporter.loop.run_until_complete(run_consumer())
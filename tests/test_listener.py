@@ -0,0 +1,149 @@
+"""
+Unit tests for listener.py module. Uses pytest framework.
+
+Packets are sent to the listener by a minimal fake TNC, running in a separate thread, that
+sends its data in small uneven chunks so that frames are split across several receive calls.
+"""
+
+from .context import tncexporter
+from .packets import utah_packets_agw
+import asyncio
+import pytest
+import socket
+import threading
+
+
+def agw_frame(packet: bytes) -> bytes:
+    """Return an AGW packet with the data length field set to the actual length of its data"""
+    return packet[:28] + len(packet[36:]).to_bytes(4, 'little') + packet[32:]
+
+
+def kiss_address(callsign: str, last: bool = False) -> bytes:
+    """Encode a callsign as an AX.25 address field"""
+    call, _, ssid = callsign.partition('-')
+    return bytes(ord(c) << 1 for c in call.ljust(6)) + \
+        bytes([0x60 | (int(ssid or 0) << 1) | (1 if last else 0)])
+
+
+def kiss_frame(call_from: str, call_to: str, info: bytes) -> bytes:
+    """Encode a KISS data frame, without frame delimiters, for a UI frame with no path"""
+    return b'\x00' + kiss_address(call_to) + kiss_address(call_from, last=True) + \
+        b'\x03\xf0' + info
+
+
+def fake_tnc(server: socket.socket, sessions: list, kiss: bool):
+    """
+    Accept a connection for each item of sessions, answer the AGW version request if needed,
+    then send the data of that session
+    """
+    for data in sessions:
+        conn, _ = server.accept()
+        with conn:
+            if not kiss:
+                conn.recv(36)  # version request
+                conn.sendall(b'\x00\x00\x00\x00R' + b'\x00' * 23 + (8).to_bytes(4, 'little')
+                             + b'\x00' * 4 + (2005).to_bytes(4, 'little')
+                             + (127).to_bytes(4, 'little'))
+                conn.recv(36)  # monitor request
+            chunk_sizes = (5, 31, 200, 1, 700, 3, 90)
+            sent = 0
+            i = 0
+            while sent < len(data):
+                size = chunk_sizes[i % len(chunk_sizes)]
+                conn.sendall(data[sent:sent + size])
+                sent += size
+                i += 1
+            # wait for the listener to close the connection
+            conn.recv(1)
+
+
+def fake_http_server(server: socket.socket):
+    """Accept one connection and answer the AGW version request with an HTTP error reply"""
+    conn, _ = server.accept()
+    with conn:
+        conn.recv(36)  # version request
+        conn.sendall(b'HTTP/1.1 400 Bad Request\r\nContent-Type: text/plain\r\n'
+                     b'Content-Length: 0\r\nConnection: close\r\n\r\n')
+
+
+def receive(data, expected_count: int, kiss: bool = False) -> list:
+    """
+    Run a listener connected to a fake TNC sending data and return the packets it queues. data
+    is either bytes, or a list of bytes with the data to send after each (re)connection
+    """
+    sessions = [data] if isinstance(data, bytes) else data
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(('127.0.0.1', 0))
+    server.listen()
+    thread = threading.Thread(target=fake_tnc, args=(server, sessions, kiss), daemon=True)
+    thread.start()
+
+    async def run_listener():
+        listener = tncexporter.listener.Listener(
+            tnc_url=f"http://127.0.0.1:{server.getsockname()[1]}", kiss_mode=kiss)
+        task = asyncio.create_task(listener.receive_packets())
+        packets = []
+        while len(packets) < expected_count:
+            await asyncio.wait_for(listener.packets_ready.wait(), 5)
+            packets += listener.drain_packets()
+        # none of the test data needs a larger receive buffer
+        assert len(listener._rx_buffer) == tncexporter.listener.RX_BUFFER_SIZE
+        task.cancel()
+        listener.disconnect()
+        return packets
+
+    try:
+        return asyncio.run(run_listener())
+    finally:
+        server.close()
+
+
+class TestListener:
+    """Test that the listener splits the data it receives into complete packets"""
+
+    def test_receive_agw(self):
+        frames = [agw_frame(p) for p in utah_packets_agw]
+        assert receive(b''.join(frames), len(frames)) == frames
+
+    def test_receive_agw_invalid_length(self):
+        """Check that the listener reconnects after a frame header with an invalid data length,
+        discarding the data received after it"""
+        frames = [agw_frame(p) for p in utah_packets_agw]
+        invalid = frames[0][:28] + (1 << 30).to_bytes(4, 'little') + frames[0][32:]
+        sessions = [b''.join(frames[:5]) + invalid + b''.join(frames[5:]), b''.join(frames[5:])]
+        assert receive(sessions, len(frames)) == frames
+
+    def test_receive_kiss(self):
+        frames = [kiss_frame('KB6CYS', 'BEACON', b'WEATHER STATION ON-LINE'),
+                  kiss_frame('PU2WZA-15', 'APN383', b'!2254.81S/04826.34W# Aprs'),
+                  kiss_frame('W6SCE-10', 'APN382', b'!3419.82N111836.06W#PHG6860')] * 20
+        data = b''.join(b'\xc0' + f + b'\xc0' for f in frames)
+        assert receive(data, len(frames), kiss=True) == frames
+
+    def test_receive_kiss_no_delimiter(self):
+        """Check that a long run of data without a frame delimiter is discarded, without
+        growing the receive buffer, and later frames are still received"""
+        frames = [kiss_frame('KB6CYS', 'BEACON', b'WEATHER STATION ON-LINE'),
+                  kiss_frame('PU2WZA-15', 'APN383', b'!2254.81S/04826.34W# Aprs')] * 10
+        data = b''.join(b'\xc0' + f + b'\xc0' for f in frames)
+        data += b'\x01' * 200000 + data
+        assert receive(data, 2 * len(frames), kiss=True) == frames * 2
+
+
+class TestConnect:
+    """Test the AGW version check made when connecting to the TNC"""
+
+    def test_connect_not_agw(self):
+        """Check that the listener quits without reading further if the reply is not from an
+        AGWPE API, here an HTTP server whose reply would give a data length of about 1.8 GB"""
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', 0))
+        server.listen()
+        thread = threading.Thread(target=fake_http_server, args=(server,), daemon=True)
+        thread.start()
+        try:
+            with pytest.raises(SystemExit):
+                tncexporter.listener.Listener(
+                    tnc_url=f"http://127.0.0.1:{server.getsockname()[1]}")
+        finally:
+            server.close()
@@ -33,6 +33,7 @@ class TestPacketParsing:
         assert test_result.frame_type == "U"
         assert test_result.call_from == 'KB6CYS'
         assert test_result.call_to == 'BEACON'
+        assert test_result.data_len == 95
         assert test_result.timestamp.hour == 14
         assert test_result.timestamp.minute == 32
         assert test_result.timestamp.second == 33
@@ -69,7 +70,7 @@ class TestPacketParsing:
         assert test_result.timestamp.second == 38
         assert test_result.hops_count == 0
         assert test_result.hops_path == []
-        assert test_result.lat_lon == (34.1982, -118.3606)
+        assert test_result.lat_lon == pytest.approx((34 + 19.82 / 60, -(118 + 36.06 / 60)))
 
     def test_parse_agw_4(self):
         raw_packet = b'\x00\x00\x00\x00U\x00\x00\x00AG7LY-7\x00\x00\x00TQQYRR\x00\x00\x00\x00f' \
@@ -117,7 +118,7 @@ class TestPacketParsing:
         assert test_result.timestamp.second == 25
         assert test_result.hops_count == 1
         assert test_result.hops_path == ['SHEPRD']
-        assert test_result.lat_lon == (40.3797, -111.5906)
+        assert test_result.lat_lon == pytest.approx((40 + 37.97 / 60, -(111 + 59.06 / 60)))
 
     def test_parse_agw_7(self):
         raw_packet = b'\x00\x00\x00\x00U\x00\x00\x00BLOW\x00\x00\x00\x00\x00\x00APDW14\x00\x00' \
@@ -133,7 +134,7 @@ class TestPacketParsing:
         assert test_result.timestamp.second == 56
         assert test_result.hops_count == 2
         assert test_result.hops_path == ['RCHFLD', 'SHEPRD']
-        assert test_result.lat_lon == (37.3551, -112.5196)
+        assert test_result.lat_lon == pytest.approx((37 + 35.51 / 60, -(112 + 51.96 / 60)))
 
     def test_parse_agw_8(self):
         raw_packet = b'\x00\x00\x00\x00U\x00\x00\x00DO0HWI\x00\x00\x00\x00APMI04\x00\x00\x00\x00' \
@@ -149,7 +150,7 @@ class TestPacketParsing:
         assert test_result.timestamp.second == 50
         assert test_result.hops_count == 1
         assert test_result.hops_path == ['DB0KUE']
-        assert test_result.lat_lon == (53.5408, 11.2480)
+        assert test_result.lat_lon == pytest.approx((53 + 54.08 / 60, 11 + 24.80 / 60))
 
     def test_parse_agw_9(self):
         raw_packet = b'\x00\x00\x00\x00U\x00\x00\x00DB0HRO\x00\x00\x00\x00APZ18\x00\x00\x00\x00' \
@@ -165,7 +166,7 @@ class TestPacketParsing:
         assert test_result.timestamp.second == 40
         assert test_result.hops_count == 0
         assert test_result.hops_path == []
-        assert test_result.lat_lon == (54.0837, 12.0282)
+        assert test_result.lat_lon == pytest.approx((54 + 8.37 / 60, 12 + 2.82 / 60))
 
     def test_parse_agw_10(self):
         raw_packet = b'\x00\x00\x00\x00U\x00\x00\x00PU2WZA-15\x00APN383\x00\x00\x00\x00q\x00\x00' \
@@ -180,7 +181,7 @@ class TestPacketParsing:
         assert test_result.timestamp.second == 23
         assert test_result.hops_count == 0
         assert test_result.hops_path == []
-        assert test_result.lat_lon == (-22.5481, -48.2634)
+        assert test_result.lat_lon == pytest.approx((-(22 + 54.81 / 60), -(48 + 26.34 / 60)))
 
     def test_parse_agw_11(self):
         raw_packet = b'\x00\x00\x00\x00U\x00\x00\x00PY2KCA-15\x00APMI01\x00\x00\x00\x00~\x00\x00' \
@@ -196,7 +197,7 @@ class TestPacketParsing:
         assert test_result.timestamp.second == 52
         assert test_result.hops_count == 1
         assert test_result.hops_path == ['PU2LYJ-15']
-        assert test_result.lat_lon == (-22.3497, -47.1061)
+        assert test_result.lat_lon == pytest.approx((-(22 + 34.97 / 60), -(47 + 10.61 / 60)))
 
     def test_parse_agw_12(self):
         raw_packet = b'\x00\x00\x00\x00U\x00\x00\x00BX2ADJ-2\x00\x00APAVT7\x00\x00\x00\x00^\x00' \
@@ -211,7 +212,7 @@ class TestPacketParsing:
         assert test_result.timestamp.second == 43
         assert test_result.hops_count == 0
         assert test_result.hops_path == []
-        assert test_result.lat_lon == (25.0063, 121.2806)
+        assert test_result.lat_lon == pytest.approx((25 + 0.63 / 60, 121 + 28.06 / 60))
 
     def test_parse_agw_13(self):
         raw_packet = b'\x00\x00\x00\x00U\x00\x00\x00BM2MCF-12\x00APAVTT\x00\x00\x00\x00\x8a\x00' \
@@ -227,7 +228,7 @@ class TestPacketParsing:
         assert test_result.timestamp.second == 31
         assert test_result.hops_count == 1
         assert test_result.hops_path == ['BX2ADJ-2']
-        assert test_result.lat_lon == (24.5975, 121.2305)
+        assert test_result.lat_lon == pytest.approx((24 + 59.75 / 60, 121 + 23.05 / 60))
 
     def test_parse_agw_14(self):
         """This test checks parsing of uncommon comma separated lat/lon values"""
@@ -245,7 +246,30 @@ class TestPacketParsing:
         assert test_result.timestamp.second == 31
         assert test_result.hops_count == 1
         assert test_result.hops_path == ['BX2ADJ-2']
-        assert test_result.lat_lon == (48.4783, 8.2982)
+        assert test_result.lat_lon == pytest.approx((48 + 47.83 / 60, 8 + 29.82 / 60))
+
+    def test_parse_agw_invalid_timestamp(self):
+        """Check that a timestamp with an hour greater than 23 is ignored without raising errors"""
+        raw_packet = b'\x00\x00\x00\x00U\x00\x00\x00KB6CYS\x00\x00\x00\x00BEACON\x00\x00\x00\x00_' \
+                     b'\x00\x00\x00\x00\x00\x00\x00 1:Fm KB6CYS To BEACON Via N6EX-4 <UI pid=F0 ' \
+                     b'Len=24 PF=0 >[25:32:33]\rWEATHER STATION ON-LINE\r\r\x00 '
+        test_result = tncexporter.parser.PacketInfo(raw_packet, kiss=False)
+        assert test_result.frame_type == "U"
+        assert test_result.call_from == 'KB6CYS'
+        assert test_result.timestamp.hour == 0
+        assert test_result.timestamp.minute == 0
+        assert test_result.timestamp.second == 0
+        assert test_result.hops_count == 1
+        assert test_result.hops_path == ['N6EX-4']
+
+    def test_parse_agw_wide_path(self):
+        """Check that a plain WIDE path without a number is not counted as a hop"""
+        raw_packet = b'\x00\x00\x00\x00U\x00\x00\x00KB6CYS\x00\x00\x00\x00BEACON\x00\x00\x00\x00_' \
+                     b'\x00\x00\x00\x00\x00\x00\x00 1:Fm KB6CYS To BEACON Via N6EX-4,WIDE <UI ' \
+                     b'pid=F0 Len=24 PF=0 >[14:32:33]\rWEATHER STATION ON-LINE\r\r\x00 '
+        test_result = tncexporter.parser.PacketInfo(raw_packet, kiss=False)
+        assert test_result.hops_count == 1
+        assert test_result.hops_path == ['N6EX-4']
 
     def test_parse_kiss_empty(self):
         """Make sure a completely empty kiss packet is parsed without raising errors"""
@@ -261,6 +285,25 @@ class TestPacketParsing:
         assert test_result.hops_path == []
         assert test_result.lat_lon == (None, None)
 
+    def test_parse_kiss_1(self):
+        raw_packet = b'\x00\x82\xa0\x9cfpd`\x96\x84l\x86\xb2\xa6a\x03\xf0!3419.82N111836.06W#' \
+                     b'PHG6860'
+        test_result = tncexporter.parser.PacketInfo(raw_packet, kiss=True)
+        assert test_result.frame_type == 'U'
+        assert test_result.call_from == 'KB6CYS'
+        assert test_result.call_to == 'APN382'
+        assert test_result.len_data == 27
+        assert test_result.hops_count == 0
+        assert test_result.hops_path == []
+        assert test_result.lat_lon == pytest.approx((34 + 19.82 / 60, -(118 + 36.06 / 60)))
+
+    def test_parse_kiss_not_data_frame(self):
+        """Check that a KISS frame that is not a data frame is rejected"""
+        raw_packet = b'\x01\x82\xa0\x9cfpd`\x96\x84l\x86\xb2\xa6a\x03\xf0!3419.82N111836.06W#' \
+                     b'PHG6860'
+        with pytest.raises(ValueError):
+            tncexporter.parser.PacketInfo(raw_packet, kiss=True)
+
 
 # TODO: refactor haversine distance tests to work with new PacketInfo interface
 class TestHaversine:
@@ -272,8 +315,8 @@ class TestHaversine:
                      b'pid=F0 Len=77 PF=0 >[14:33:38]\r!3419.82N111836.06W#PHG6860/W1 on Oat ' \
                      b'Mtn./A=003747/k6ccc@amsat.org for info\r\r\x00 '
         parsed = tncexporter.parser.PacketInfo(raw_packet, kiss=False)
-        assert parsed.lat_lon == (34.1982, -118.3606)
-        assert round(parsed.haversine_distance(tnc_pos=(33, -118)), 2) == 137355.59
+        assert parsed.lat_lon == pytest.approx((34 + 19.82 / 60, -(118 + 36.06 / 60)))
+        assert round(parsed.haversine_distance(tnc_pos=(33, -118)), 2) == 158036.39
 
     def test_haversine_2(self):
         raw_packet = b'\x00\x00\x00\x00U\x00\x00\x00BM2MCF-12\x00APAVTT\x00\x00\x00\x00\x8a\x00' \
@@ -282,5 +325,29 @@ class TestHaversine:
                      b'00829.8295,E,2,11,0.9,714.1,M,47.9,M,1.8,0000*7EF0 Len=79 PF=0 >' \
                      b'[19:15:16]\r\x00'
         parsed = tncexporter.parser.PacketInfo(raw_packet, kiss=False)
-        assert parsed.lat_lon == (48.4783, 8.2982)
-        assert round(parsed.haversine_distance(tnc_pos=(33, -118)), 2) == 9505923.52
+        assert parsed.lat_lon == pytest.approx((48 + 47.83 / 60, 8 + 29.82 / 60))
+        assert round(parsed.haversine_distance(tnc_pos=(33, -118)), 2) == 9489728.44
+
+    def test_equirectangular(self):
+        """Check that the equirectangular approximation is close to the haversine distance"""
+        raw_packet = b'\x00\x00\x00\x00T\x00\x00\x00W6SCE-10\x00\x00APN382\x00\x00\x00\x00\x97' \
+                     b'\x00\x00\x00\x00\x00\x00\x00 1:Fm W6SCE-10 To APN382 Via WIDE2-1 <UI ' \
+                     b'pid=F0 Len=77 PF=0 >[14:33:38]\r!3419.82N111836.06W#PHG6860/W1 on Oat ' \
+                     b'Mtn./A=003747/k6ccc@amsat.org for info\r\r\x00 '
+        parsed = tncexporter.parser.PacketInfo(raw_packet, kiss=False)
+        haversine = parsed.haversine_distance(tnc_pos=(33, -118))
+        equirectangular = parsed.haversine_distance(tnc_pos=(33, -118), method='equirectangular')
+        assert equirectangular == pytest.approx(haversine, rel=1e-4)
+
+    def test_distance_from(self):
+        """Check that distance_from a TncPos matches haversine_distance for both methods"""
+        raw_packet = b'\x00\x00\x00\x00T\x00\x00\x00W6SCE-10\x00\x00APN382\x00\x00\x00\x00\x97' \
+                     b'\x00\x00\x00\x00\x00\x00\x00 1:Fm W6SCE-10 To APN382 Via WIDE2-1 <UI ' \
+                     b'pid=F0 Len=77 PF=0 >[14:33:38]\r!3419.82N111836.06W#PHG6860/W1 on Oat ' \
+                     b'Mtn./A=003747/k6ccc@amsat.org for info\r\r\x00 '
+        parsed = tncexporter.parser.PacketInfo(raw_packet, kiss=False)
+        tnc_pos = tncexporter.parser.TncPos(33, -118)
+        assert round(parsed.distance_from(tnc_pos), 2) == 158036.39
+        for method in ('haversine', 'equirectangular'):
+            assert parsed.distance_from(tnc_pos, method=method) == \
+                pytest.approx(parsed.haversine_distance(tnc_pos=(33, -118), method=method))
@@ -6,6 +6,15 @@ import argparse
 import logging
 import asyncio
 from .exporter import TNCExporter
+from .parser import DISTANCE_METHODS
+
+
+def positive_int(value: str) -> int:
+    """argparse type for arguments that must be a positive integer"""
+    number = int(value)
+    if number <= 0:
+        raise argparse.ArgumentTypeError(f"must be a positive integer, not {value}")
+    return number
 
 
 def main():
@@ -45,7 +54,7 @@ def main():
     parser.add_argument(
         "--update-interval",
         metavar="<stats data refresh interval>",
-        type=int,
+        type=positive_int,
         dest="update_interval",
         default=30,
         help="The number of seconds between updates of TNC metrics. This determines the rate at "
@@ -71,6 +80,23 @@ def main():
              "west are negative. If this is empty, the exporter will not calculate the relative"
              " distance of position packets."
     )
+    parser.add_argument(
+        "--distance-method",
+        choices=DISTANCE_METHODS,
+        dest="distance_method",
+        default="haversine",
+        help="Formula used to calculate the distance of position packets from the TNC. The "
+             "equirectangular approximation is faster and accurate at the ranges packets are "
+             "usually heard over, but less accurate for very distant stations. Default is "
+             "haversine."
+    )
+    parser.add_argument(
+        "--uvloop",
+        action="store_true",
+        default=False,
+        help="Run the exporter on the uvloop event loop, which is faster than the default asyncio "
+             "event loop. uvloop must be installed separately, and is not available on Windows."
+    )
     parser.add_argument(
         "--debug", action="store_true", default=False, help="Print debug messages to stdout"
     )
@@ -105,6 +131,15 @@ def main():
     else:
         logging.warning("Missing latitude/longitude values. Distance metrics will not be exported.")
 
+    if args.uvloop:
+        try:
+            import uvloop
+        except ImportError:
+            logging.warning("Could not import uvloop, using the default asyncio event loop instead")
+        else:
+            asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+            logging.debug("Using uvloop event loop")
+
     loop = asyncio.get_event_loop()
     exp = TNCExporter(
         tnc_url=args.tnc_url,
@@ -112,7 +147,8 @@ def main():
         port=args.port,
         kiss_mode=args.kiss_mode,
         stats_interval=args.update_interval,
-        receiver_location=location
+        receiver_location=location,
+        distance_method=args.distance_method
     )
     try:
         # start metrics server and listener
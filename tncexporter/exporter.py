@@ -9,17 +9,41 @@ from .metrics import PACKET_RX, PACKET_TX, PACKET_DISTANCE, RX_PACKET_SIZE, TX_P
     RF_PACKET_DISTANCE, MAX_DISTANCE_RECENT, PACKET_RX_RECENT_PATH, PACKET_RX_RECENT_FRAME, \
     PACKET_TX_RECENT_PATH
 import asyncio
+import collections
+import concurrent.futures
 import datetime
 import logging
 from .listener import Listener
 from asyncio.events import AbstractEventLoop
 from aioprometheus import Service
-from .parser import PacketInfo
+from .parser import PacketInfo, TncPos, DISTANCE_METHODS
 from typing import List
 
 logger = logging.getLogger(__name__)
 
 
+def _parse_packets(raw_packets: List[bytes], kiss_mode: bool) -> List[PacketInfo]:
+    """
+    Parse a batch of packet byte strings into PacketInfo objects. Runs in the exporter's worker
+    thread, so that parsing doesn't hold up the event loop receiving packets from the TNC.
+
+    :param raw_packets: list of packet byte strings received by the listener
+    :param kiss_mode: parse packets as KISS frames instead of AGW frames
+    :returns: list of PacketInfo objects, skipping any packets that raised an error
+    """
+    packet_format = 'KISS' if kiss_mode else 'AGW'
+    parsed_packets = []
+    for packet in raw_packets:
+        try:
+            parsed = PacketInfo(packet, kiss=kiss_mode)
+        except Exception:
+            logging.exception("Error parsing packet: ")
+            continue
+        logging.debug("Parsed %s packet: %r", packet_format, parsed)
+        parsed_packets.append(parsed)
+    return parsed_packets
+
+
 class TNCExporter:
     def __init__(
             self,
@@ -29,18 +53,65 @@ class TNCExporter:
             kiss_mode: bool = False,
             stats_interval: int = 60,
             receiver_location: tuple = None,
+            distance_method: str = 'haversine',
             loop: AbstractEventLoop = None) -> None:
+        if distance_method not in DISTANCE_METHODS:
+            raise ValueError(f"Unknown distance method: {distance_method}")
+        if stats_interval <= 0:
+            raise ValueError(f"Stats interval must be a positive number of seconds, "
+                             f"not {stats_interval}")
         self.loop = loop or asyncio.get_event_loop()
         self.kiss_mode = kiss_mode
         self.tnc_url = tnc_url
         self.host = host
         self.port = port
         self.stats_interval = datetime.timedelta(seconds=stats_interval)
+        self.interval_seconds = self.stats_interval.total_seconds()
         self.location = receiver_location
+        # method used to calculate distances, 'haversine' or 'equirectangular'
+        self.distance_method = distance_method
+        if self.location is not None \
+                and self.location[0] is not None and self.location[1] is not None:
+            # the TNC location is fixed, so convert it to radians once for distance calculations
+            self.tnc_pos = TncPos(*self.location)
+        else:
+            self.location = None
+            self.tnc_pos = None
+        # label sets used by summary_metrics, built once as they only depend on the interval
+        self.interval_label = f'Last {self.stats_interval.seconds} seconds'
+        self.distance_labels = {path: {'interval': self.interval_label, 'path': path}
+                                for path in ('Simplex', 'Digipeated')}
+        self.frame_labels = {frame: {'interval': self.interval_label,
+                                     'path': 'All',
+                                     'frame_type': frame}
+                             for frame in ('All', 'U', 'I', 'S', 'Unknown')}
+        self.path_labels = {path: {'interval': self.interval_label,
+                                   'path': path,
+                                   'frame_type': 'All'}
+                            for path in ('All', 'Simplex', 'Digipeated')}
+        # label sets used by packet_metrics for every packet, built once here instead of for
+        # each packet. aioprometheus serializes labels to look up the metric value, so the same
+        # dicts can be passed on every call
+        self.tx_labels = {path: {'path': path} for path in ('Simplex', 'Digipeated')}
+        self.distance_labels_unknown = {'type': 'unknown'}
+        self.no_labels = {}
+        # histograms updated by packet_metrics, with the labels they are observed with
+        self.histograms = {'rx_size': (RX_PACKET_SIZE, self.no_labels),
+                           'tx_size': (TX_PACKET_SIZE, self.no_labels),
+                           'distance': (PACKET_DISTANCE, self.distance_labels_unknown),
+                           'rf_distance': (RF_PACKET_DISTANCE, self.distance_labels_unknown)}
+        # maximum distance of received position packets by path type, updated by packet_metrics
+        # as packets are processed and reset by summary_metrics at the end of each interval
+        self.max_distance = {'Simplex': 0.0, 'Digipeated': 0.0}
+        # packets processed by packet_consumer since the summary metrics were last updated
+        self.interval_packets = []
         self.listener = None
         self.metrics_task = None
+        self.consumer_task = None
         self.listener_task = None
         self.server = Service()
+        # single worker thread that packets are parsed in
+        self.parse_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
         self.register_metrics((PACKET_RX,
                                PACKET_TX,
                                RX_PACKET_SIZE,
@@ -64,9 +135,10 @@ class TNCExporter:
         self.listener = Listener(tnc_url=self.tnc_url, kiss_mode=self.kiss_mode)
         # start prometheus metrics server
         await self.server.start(addr=self.host, port=self.port)
-        logger.info(f"Serving TNC prometheus metrics on: {self.server.metrics_url}")
+        logger.info("Serving TNC prometheus metrics on: %s", self.server.metrics_url)
         # create long-running asyncio tasks to listen for packets and update metrics
         self.metrics_task = asyncio.create_task(self.metric_updater())
+        self.consumer_task = asyncio.create_task(self.packet_consumer())
         self.listener_task = asyncio.create_task(self.listener.receive_packets())
 
     async def stop(self) -> None:
@@ -78,6 +150,13 @@ class TNCExporter:
             except asyncio.CancelledError:
                 pass
             self.metrics_task = None
+        if self.consumer_task:
+            self.consumer_task.cancel()
+            try:
+                await self.consumer_task
+            except asyncio.CancelledError:
+                pass
+            self.consumer_task = None
         if self.listener_task:
             self.listener_task.cancel()
             try:
@@ -86,76 +165,143 @@ class TNCExporter:
                 pass
             self.listener_task = None
         await self.server.stop()  # stop prometheus server
+        self.parse_executor.shutdown(wait=False)
         self.listener.disconnect()  # disconnect listener from TNC
 
-    async def metric_updater(self):
-        """Asynchronous coroutine function that reads the queue of received packets and calls
-        packet_metrics on each packet in the queue. Runs on an interval defined by the update
-        interval set when starting the exporter."""
-
+    async def packet_consumer(self):
+        """Asynchronous coroutine function that waits for the listener to receive packets, then
+        takes all packets from its queue and calls packet_metrics on each of them. Processed
+        packets are kept for the summary metrics calculated by metric_updater."""
         while True:
-            packets_to_summarize = []
-            start = datetime.datetime.now()
+            await self.listener.packets_ready.wait()
+            # count of received packets per set of PACKET_RX labels, added to PACKET_RX once
+            # the batch has been processed
+            rx_counts = collections.Counter()
+            # values observed by histograms, added to them once the batch has been processed
+            observations = collections.defaultdict(list)
             try:
-                logging.debug("Metrics task checking queue for packets")
-                # Only try to get packet bytestrings from the queue if it is not empty
-                while not self.listener.packet_queue.empty():
-                    packet = await self.listener.packet_queue.get()
-                    # check if KISS mode is turned on, otherwise use AGW packet parser
-                    if self.kiss_mode:
-                        parsed = PacketInfo(packet, kiss=True)
-                        logging.debug(f"Parsed KISS packet: {parsed.__dict__}")
-                    else:
-                        parsed = PacketInfo(packet, kiss=False)
-                        logging.debug(f"Parsed AGW packet: {parsed.__dict__}")
-
-                    self.packet_metrics(parsed)
-                    logging.debug("Updated metrics for packet received from TNC")
-                    packets_to_summarize.append(parsed)
-                    self.listener.packet_queue.task_done()
+                # Take all packet bytestrings from the queue
+                raw_packets = self.listener.drain_packets()
+                # parse packets in the worker thread, then update metrics on the event loop
+                parsed_packets = await self.loop.run_in_executor(
+                    self.parse_executor, _parse_packets, raw_packets, self.kiss_mode)
+                for parsed in parsed_packets:
+                    self.packet_metrics(parsed, rx_counts, observations)
+                self.packet_rx_metrics(rx_counts)
+                self.packet_histogram_metrics(observations)
+                self.interval_packets.extend(parsed_packets)
+                logging.debug("Updated metrics for %d packets received from TNC",
+                              len(parsed_packets))
             except Exception:
                 logging.exception("Error processing packet into metrics: ")
-            try:
-                self.summary_metrics(packets_to_summarize)
-            except Exception:
-                logging.exception("Error processing summary metrics from packets: ")
-            # await end of sleep cycle to update metrics, defined by update-interval parameter
-            logging.info(f"Updated metrics for {len(packets_to_summarize)} packets")
-            end = datetime.datetime.now()
-            wait_seconds = (start + self.stats_interval - end).total_seconds()
-            logging.debug(f"Metrics task sleeping for {wait_seconds:.2f} seconds")
+
+    async def metric_updater(self):
+        """Asynchronous coroutine function that calculates summary metrics from the packets
+        processed by packet_consumer. Runs on an interval defined by the update interval set
+        when starting the exporter."""
+
+        # whether the previous interval received no packets, in which case the summary metrics
+        # have already been set to zero
+        idle = False
+        # updates are scheduled at fixed times on the event loop's monotonic clock, so the time
+        # spent updating metrics doesn't cause the interval to drift
+        next_update = self.loop.time()
+        while True:
+            # take the packets processed since the last update
+            packets_to_summarize = self.interval_packets
+            self.interval_packets = []
+            # skip the summary metrics if this interval and the last both received no packets,
+            # as they would only be set to zero again
+            if packets_to_summarize or not idle:
+                try:
+                    self.summary_metrics(packets_to_summarize)
+                except Exception:
+                    logging.exception("Error processing summary metrics from packets: ")
+                logging.info("Updated metrics for %d packets", len(packets_to_summarize))
+            idle = not packets_to_summarize
+            # await end of sleep cycle to update metrics, defined by update-interval parameter.
+            # If updating took longer than the interval, skip the updates that were missed
+            now = self.loop.time()
+            while next_update <= now:
+                next_update += self.interval_seconds
+            wait_seconds = next_update - now
+            logging.debug("Metrics task sleeping for %.2f seconds", wait_seconds)
             await asyncio.sleep(wait_seconds)
 
-    def packet_metrics(self, packet_info: PacketInfo):
+    def packet_metrics(self, packet_info: PacketInfo, rx_counts: collections.Counter,
+                       observations: collections.defaultdict):
         """
         Function that processes individual packet metadata from a PacketInfo object
-         and updates Prometheus metrics.
+         and updates Prometheus metrics. Received packets and histogram values are collected
+         in rx_counts and observations, then added to their metrics once per batch of packets
+         by packet_rx_metrics and packet_histogram_metrics.
 
         :param packet_info: a PacketInfo object containing packet metadata
+        :param rx_counts: Counter of received packets keyed by a tuple of frame type, path type
+         and originating callsign
+        :param observations: defaultdict of lists of histogram values keyed by the names in
+         self.histograms
         """
-        path_type = "Digipeated" if packet_info.hops_count > 0 else "Simplex"
+        hops_count = packet_info.hops_count
+        path_type = "Digipeated" if hops_count > 0 else "Simplex"
 
         if packet_info.frame_type == 'T':
             # if a packet is transmitted, increment PACKET_TX
-            PACKET_TX.inc({'path': path_type})
-            TX_PACKET_SIZE.observe({}, packet_info.len_data)
+            PACKET_TX.inc(self.tx_labels[path_type])
+            observations['tx_size'].append(packet_info.len_data)
         else:
-            RX_PACKET_SIZE.observe({}, packet_info.len_data)
-            # if a packet is received and decoded, increment PACKET_RX metric
-            PACKET_RX.inc({'ax25_frame_type': packet_info.frame_type,
-                           'path': path_type,
-                           'from_cs': packet_info.call_from})
-            if self.location \
-                    and all([v is not None for v in packet_info.lat_lon]) \
-                    and all([w is not None for w in self.location]):
-                # calculate distance between TNC location and packet's reported lat/lon
-                distance_from_tnc = packet_info.haversine_distance(tnc_pos=self.location)
+            observations['rx_size'].append(packet_info.len_data)
+            # if a packet is received and decoded, count it for the PACKET_RX metric
+            rx_counts[(packet_info.frame_type, path_type, packet_info.call_from)] += 1
+            lat_rad = packet_info.lat_rad
+            if lat_rad is not None and self.location is not None:
+                # calculate distance between TNC location and packet's reported lat/lon, using
+                # the radians calculated when the packet was parsed
+                distance = packet_info.distance_from(self.tnc_pos, method=self.distance_method)
+                if distance > self.max_distance[path_type]:
+                    self.max_distance[path_type] = distance
                 # Update PACKET_DISTANCE for all received packets with lat/lon info, including
                 # ones received by digipeating
-                PACKET_DISTANCE.observe({'type': 'unknown'}, distance_from_tnc)
-                if packet_info.hops_count == 0:
+                observations['distance'].append(distance)
+                if hops_count == 0:
                     # No hops means the packet was received via RF, so update RF_PACKET_DISTANCE
-                    RF_PACKET_DISTANCE.observe({'type': 'unknown'}, distance_from_tnc)
+                    observations['rf_distance'].append(distance)
+
+    @staticmethod
+    def packet_rx_metrics(rx_counts: collections.Counter):
+        """
+        Add counts of received packets collected by packet_metrics to PACKET_RX, so that each
+        unique set of labels is only updated once.
+
+        :param rx_counts: Counter of received packets keyed by a tuple of frame type, path type
+         and originating callsign
+        """
+        for (frame_type, path_type, call_from), count in rx_counts.items():
+            PACKET_RX.add({'ax25_frame_type': frame_type,
+                           'path': path_type,
+                           'from_cs': call_from},
+                          count)
+
+    def packet_histogram_metrics(self, observations: dict):
+        """
+        Add values collected by packet_metrics to their histograms. The labels of each histogram
+        are only looked up once per batch, then values are added directly to the underlying
+        histogram for that label set.
+
+        :param observations: dict of lists of values keyed by the names in self.histograms
+        """
+        for name, values in observations.items():
+            if not values:
+                continue
+            metric, labels = self.histograms[name]
+            # the first observation creates the histogram for this label set if needed
+            metric.observe(labels, values[0])
+            # get_value returns the aioprometheus.histogram.Histogram that aggregates the values
+            # of this label set. This relies on the internals of aioprometheus 20.0.1, the
+            # version pinned in requirements.txt
+            histogram = metric.get_value(labels)
+            for value in values[1:]:
+                histogram.observe(float(value))
 
     def summary_metrics(self, packets: List[PacketInfo]):
         """
@@ -174,98 +320,55 @@ class TNCExporter:
         packets_tx_count: int = 0
         packets_tx_digi_count: int = 0
         packets_tx_simplex_count: int = 0
-        max_rf_distance: float = 0
-        max_digi_distance: float = 0
         if len(packets) > 0:
-            logging.debug(f"Calculating summary metrics for {len(packets)} packets")
-            packets_rx = [p for p in packets if p.frame_type != 'T']
-            packets_tx = [p for p in packets if p.frame_type == 'T']
-            packets_rx_count = len(packets_rx)
-            packets_rx_u_count = len([p for p in packets_rx if p.frame_type == 'U'])
-            packets_rx_i_count = len([p for p in packets_rx if p.frame_type == 'I'])
-            packets_rx_s_count = len([p for p in packets_rx if p.frame_type == 'S'])
-            packets_rx_unknown_count = len([p for p in packets_rx if p.frame_type == 'Unknown'])
-            packets_rx_digi_count = len([p for p in packets_rx if p.hops_count > 0])
-            packets_rx_simplex_count = len([p for p in packets_rx if p.hops_count == 0])
-            packets_tx_count = len(packets_tx)
-            packets_tx_digi_count = len([p for p in packets_tx if p.hops_count > 0])
-            packets_tx_simplex_count = len([p for p in packets_tx if p.hops_count == 0])
-
-            if self.location and all([w is not None for w in self.location]):
-                # ValueError is raised if max arg is empty
-                try:
-                    max_rf_distance = max(
-                        [p.haversine_distance(tnc_pos=self.location) for p
-                         in packets_rx if all([w is not None for w in p.lat_lon])
-                         and p.hops_count == 0])
-                except ValueError:
-                    pass
-                try:
-                    max_digi_distance = max(
-                        [p.haversine_distance(tnc_pos=self.location) for p
-                         in packets_rx if all([w is not None for w in p.lat_lon])
-                         and p.hops_count > 0])
-                except ValueError:
-                    pass
+            logging.debug("Calculating summary metrics for %d packets", len(packets))
+            # count packets by frame type and path in a single pass
+            rx_frame_counts = collections.Counter()
+            for p in packets:
+                frame_type = p.frame_type
+                if frame_type == 'T':
+                    if p.hops_count > 0:
+                        packets_tx_digi_count += 1
+                    else:
+                        packets_tx_simplex_count += 1
+                    continue
+                rx_frame_counts[frame_type] += 1
+                if p.hops_count > 0:
+                    packets_rx_digi_count += 1
+                else:
+                    packets_rx_simplex_count += 1
+            packets_rx_count = packets_rx_digi_count + packets_rx_simplex_count
+            packets_rx_u_count = rx_frame_counts['U']
+            packets_rx_i_count = rx_frame_counts['I']
+            packets_rx_s_count = rx_frame_counts['S']
+            packets_rx_unknown_count = rx_frame_counts['Unknown']
+            packets_tx_count = packets_tx_digi_count + packets_tx_simplex_count
 
-        # Update summary metrics for last update interval
-        MAX_DISTANCE_RECENT.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                 'path': 'Simplex'},
-                                max_rf_distance)
-        MAX_DISTANCE_RECENT.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                 'path': 'Digipeated'},
-                                max_digi_distance)
+        # Update summary metrics for last update interval. Maximum distances were tracked by
+        # packet_metrics, and are reset for the next interval
+        MAX_DISTANCE_RECENT.set(self.distance_labels['Simplex'], self.max_distance['Simplex'])
+        MAX_DISTANCE_RECENT.set(self.distance_labels['Digipeated'],
+                                self.max_distance['Digipeated'])
+        self.max_distance['Simplex'] = 0.0
+        self.max_distance['Digipeated'] = 0.0
         # Set count of all packets received, including all paths and frame types
-        PACKET_RX_RECENT_FRAME.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                    'path': 'All',
-                                    'frame_type': 'All'},
-                                   packets_rx_count)
+        PACKET_RX_RECENT_FRAME.set(self.frame_labels['All'], packets_rx_count)
         # Set count of U frames received
-        PACKET_RX_RECENT_FRAME.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                    'path': 'All',
-                                    'frame_type': 'U'},
-                                   packets_rx_u_count)
+        PACKET_RX_RECENT_FRAME.set(self.frame_labels['U'], packets_rx_u_count)
         # Set count of I frames received
-        PACKET_RX_RECENT_FRAME.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                    'path': 'All',
-                                    'frame_type': 'I'},
-                                   packets_rx_i_count)
+        PACKET_RX_RECENT_FRAME.set(self.frame_labels['I'], packets_rx_i_count)
         # Set count of S frames received
-        PACKET_RX_RECENT_FRAME.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                    'path': 'All',
-                                    'frame_type': 'S'},
-                                   packets_rx_s_count)
+        PACKET_RX_RECENT_FRAME.set(self.frame_labels['S'], packets_rx_s_count)
         # Set count of unknown type frames received
-        PACKET_RX_RECENT_FRAME.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                    'path': 'All',
-                                    'frame_type': 'Unknown'},
-                                   packets_rx_unknown_count)
+        PACKET_RX_RECENT_FRAME.set(self.frame_labels['Unknown'], packets_rx_unknown_count)
         # Set count of simplex packets received, including all frame types
-        PACKET_RX_RECENT_PATH.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                   'path': 'All',
-                                   'frame_type': 'All'},
-                                  packets_rx_count)
+        PACKET_RX_RECENT_PATH.set(self.path_labels['All'], packets_rx_count)
         # Set count of simplex packets received, including all frame types
-        PACKET_RX_RECENT_PATH.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                   'path': 'Simplex',
-                                   'frame_type': 'All'},
-                                  packets_rx_simplex_count)
+        PACKET_RX_RECENT_PATH.set(self.path_labels['Simplex'], packets_rx_simplex_count)
         # Set count of digipeated packets received, including all frame types
-        PACKET_RX_RECENT_PATH.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                   'path': 'Digipeated',
-                                   'frame_type': 'All'},
-                                  packets_rx_digi_count)
-        PACKET_TX_RECENT_PATH.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                   'path': 'All',
-                                   'frame_type': 'All'},
-                                  packets_tx_count)
+        PACKET_RX_RECENT_PATH.set(self.path_labels['Digipeated'], packets_rx_digi_count)
+        PACKET_TX_RECENT_PATH.set(self.path_labels['All'], packets_tx_count)
         # Set count of simplex packets transmitted, including all frame types
-        PACKET_TX_RECENT_PATH.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                   'path': 'Simplex',
-                                   'frame_type': 'All'},
-                                  packets_tx_simplex_count)
+        PACKET_TX_RECENT_PATH.set(self.path_labels['Simplex'], packets_tx_simplex_count)
         # Set count of digipeated packets transmitted, including all frame types
-        PACKET_TX_RECENT_PATH.set({'interval': f'Last {self.stats_interval.seconds} seconds',
-                                   'path': 'Digipeated',
-                                   'frame_type': 'All'},
-                                  packets_tx_digi_count)
+        PACKET_TX_RECENT_PATH.set(self.path_labels['Digipeated'], packets_tx_digi_count)
@@ -3,12 +3,15 @@ This module contains the functionality for connecting to the TNC's TCP/IP interf
 packets and extracting specific kinds of data to be instrumented.
 """
 import asyncio
+import collections
 from urllib.parse import urlparse
 import socket
 import logging
 from asyncio.events import AbstractEventLoop
 from time import sleep
+import struct
 import sys
+from .parser import AGW_HEADER
 
 # AGWPE format packet to request version from TNC host
 VERSION_REQUEST = b"\x00\x00\x00\x00\x52\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00" \
@@ -20,15 +23,53 @@ MONITOR_REQUEST = b"\x00\x00\x00\x00\x6D\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00
                   b"\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00" \
                   b"\x00\x00\x00\x00"
 
+# Length in bytes of the header at the start of every AGWPE frame. The length of the data
+# following the header is stored as a little-endian integer in bytes 28-31 of the header.
+AGW_HEADER_LENGTH = AGW_HEADER.size
+# Unpacks only the data length from an AGWPE header, for splitting received data into frames
+AGW_DATA_LEN = struct.Struct('<28xI')
+# Data of the AGWPE version reply: major version and minor version, each followed by two
+# reserved bytes
+AGW_VERSION = struct.Struct('<H2xH2x')
+# Maximum length in bytes of the data following an AGWPE header. Monitored frames are an AX.25
+# frame of at most a few hundred bytes plus the monitor header text added by the TNC, so a
+# larger length means the data received is not an AGWPE frame
+AGW_MAX_DATA_LEN = 4096
+# Maximum length in bytes of an incomplete KISS frame kept until its closing frame delimiter is
+# received. This is several times the size of an AX.25 frame, even with every byte escaped, so
+# a longer frame means the data received is not aligned with KISS frames
+KISS_MAX_FRAME_LEN = 4096
+
+# Initial size in bytes of the buffer that data from the TNC is received into. This limits how
+# much data is read, and so how many packets are queued, each time the event loop reads the socket
+RX_BUFFER_SIZE = 64 * 1024
+
+# Maximum number of received packets held until the exporter takes them from the queue
+PACKET_QUEUE_LENGTH = 4096
+
 
 class Listener:
     """Class for creating listener objects that connect to AGWPE TCP/IP API and capture packets"""
-    def __init__(self, tnc_url: str, kiss_mode: bool = False, loop: AbstractEventLoop = None):
+    def __init__(self, tnc_url: str, kiss_mode: bool = False, loop: AbstractEventLoop = None,
+                 recv_buffer_size: int = 1 << 20):
         self.parsed_url = urlparse(tnc_url)
         self.tnc_host = self.parsed_url.hostname  # tnc host to connect to
         self.tnc_port = int(self.parsed_url.port)  # tnc port to listen on
-        self.packet_queue = asyncio.Queue()
-        self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # received packets waiting for the exporter. There is only one producer and one consumer,
+        # so a deque is used, with an event set when packets are added to it
+        self.packet_queue = collections.deque(maxlen=PACKET_QUEUE_LENGTH)
+        self.packets_ready = asyncio.Event()
+        # buffer that packets are received into, grown if a packet does not fit
+        self._rx_buffer = bytearray(RX_BUFFER_SIZE)
+        self._rx_view = memoryview(self._rx_buffer)
+        # number of bytes at the start of the buffer belonging to an incomplete frame
+        self._rx_len = 0
+        # whether the data received up to the next KISS frame delimiter should be discarded,
+        # after an incomplete frame exceeded KISS_MAX_FRAME_LEN
+        self._kiss_discard = False
+        self.transport = None  # transport for the connection once packets are being received
+        self.recv_buffer_size = recv_buffer_size  # size of the kernel receive buffer of the socket
+        self.client_socket = self._make_socket()
         if kiss_mode:
             self.kiss_mode = True
             self.connect_kiss(self.tnc_host, self.tnc_port)
@@ -38,113 +79,264 @@ class Listener:
         self.api_version = None  # version returned by host API
         self.loop = loop or asyncio.get_event_loop()
 
+    def _make_socket(self) -> socket.socket:
+        """
+        Create a TCP socket for connecting to the TNC. Nagle's algorithm is disabled so that the
+        small AGWPE requests are sent immediately, and the kernel receive buffer is enlarged to
+        hold bursts of packets. The receive buffer size must be set before connecting.
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.recv_buffer_size)
+        return sock
+
+    @staticmethod
+    def _recv_exactly(sock: socket.socket, n: int) -> bytes:
+        """Receive exactly n bytes from a blocking socket into a preallocated buffer"""
+        buffer = bytearray(n)
+        view = memoryview(buffer)
+        recv_into = sock.recv_into
+        bytes_recv = 0
+        while bytes_recv < n:
+            received = recv_into(view[bytes_recv:])
+            if received == 0:
+                raise ConnectionResetError("Socket connection broken")
+            bytes_recv += received
+        return bytes(buffer)
+
     def connect_agw(self, host: str, port: int, retry_delay: int = 10):
         """Connect to a TNC's AGWPE API"""
         while True:
             try:
-                logging.info(f"Attempting to connect to TNC at {host}:{port}")
+                logging.info("Attempting to connect to TNC at %s:%s", host, port)
                 self.client_socket.connect((host, port))
             except ConnectionRefusedError:
-                logging.error(f"Could not connect to TNC at {host}:{port}, connection refused. "
-                              f"Retrying in {retry_delay} seconds")
+                logging.error("Could not connect to TNC at %s:%s, connection refused. "
+                              "Retrying in %s seconds", host, port, retry_delay)
                 sleep(retry_delay)
                 continue
             else:
-                logging.info(f"Connection established to TNC at {host}:{port}")
+                logging.info("Connection established to TNC at %s:%s", host, port)
                 break
         # send version request packet to TNC
         # this provides a check as to whether you are connecting to an actual TNC that
         # exposes an AGWPE API, as well as logging the version response for debugging
         logging.debug("Sending version request to TNC")
         self.client_socket.sendall(VERSION_REQUEST)
-        version_packet = b""
-        bytes_recv = 0
-        while bytes_recv < 36:
-            chunk = self.client_socket.recv(4096)
-            if chunk == b'':
-                raise ConnectionResetError("Socket connection broken")
-            version_packet += chunk
-            bytes_recv += len(chunk)
-        if chr(version_packet[4]) == 'R':
-            # read major and minor versions from packet sent by TNC
-            maj_ver = int.from_bytes(version_packet[36:38], 'little')
-            min_ver = int.from_bytes(version_packet[40:42], 'little')
-            logging.debug(f"Received TNC version info: {maj_ver}.{min_ver} ")
-            self.client_socket.sendall(MONITOR_REQUEST)  # ask tnc to send monitor packets
-        else:
+        # read the reply header, and check it before reading the version data whose length is
+        # given in the header, as the header may not be from an AGWPE API at all
+        version_header = self._recv_exactly(self.client_socket, AGW_HEADER_LENGTH)
+        _, data_kind, _, _, _, data_len, _ = AGW_HEADER.unpack(version_header)
+        if data_kind != 0x52 or not AGW_VERSION.size <= data_len <= AGW_MAX_DATA_LEN:
             # If the version response packet doesn't report the expected R packet type in byte 4,
-            # shut everything down as you're probably not communicating with the AGWPE API
+            # or a plausible length of version data, shut everything down as you're probably not
+            # communicating with the AGWPE API
             logging.error("Did not receive expected reply when connecting to TNC. Quitting.")
-            logging.debug("Received the following packet in response to version request:",
-                          version_packet)
+            logging.debug("Received the following packet header in response to version "
+                          "request: %r", version_header)
+            self.client_socket.close()
             sys.exit()
+        version_data = self._recv_exactly(self.client_socket, data_len)
+        # read major and minor versions from packet sent by TNC
+        maj_ver, min_ver = AGW_VERSION.unpack_from(version_data)
+        logging.debug("Received TNC version info: %d.%d", maj_ver, min_ver)
+        self.client_socket.sendall(MONITOR_REQUEST)  # ask tnc to send monitor packets
 
     def connect_kiss(self, host: str, port: int, retry_delay: int = 10):
         """Connect to a TNC's KISS TCP interface"""
         while True:
             try:
-                logging.info(f"Attempting to connect to TNC at {host}:{port}")
+                logging.info("Attempting to connect to TNC at %s:%s", host, port)
                 self.client_socket.connect((host, port))
             except ConnectionRefusedError:
-                logging.error(f"Could not connect to TNC at {host}:{port}, connection refused. "
-                              f"Retrying in {retry_delay} seconds")
+                logging.error("Could not connect to TNC at %s:%s, connection refused. "
+                              "Retrying in %s seconds", host, port, retry_delay)
                 sleep(retry_delay)
                 continue
             else:
-                logging.info(f"Connection established to TNC at {host}:{port}")
+                logging.info("Connection established to TNC at %s:%s", host, port)
                 break
 
     def disconnect(self):
-        """Close client socket connection"""
-        self.client_socket.shutdown(socket.SHUT_RDWR)
-        self.client_socket.detach()
+        """Close the connection to the TNC"""
+        if self.transport is not None:
+            # closing the transport removes the socket from the event loop and closes it
+            self.transport.close()
+            self.transport = None
+        else:
+            self.client_socket.close()
         logging.info("Closed connection to TNC")
 
+    def drain_packets(self) -> list:
+        """Remove all packets currently in the packet queue and return them as a list"""
+        packets = list(self.packet_queue)
+        self.packet_queue.clear()
+        self.packets_ready.clear()
+        return packets
+
+    def reconnect(self):
+        """Close the client socket after the connection is lost and connect to the TNC again"""
+        self.client_socket.close()
+        # remake client socket
+        self.client_socket = self._make_socket()
+        if self.kiss_mode:
+            self.connect_kiss(self.tnc_host, self.tnc_port)
+        else:
+            self.connect_agw(self.tnc_host, self.tnc_port)
+        # discard any partial frame received before the connection was lost
+        self._rx_len = 0
+        self._kiss_discard = False
+
+    def _grow_rx_buffer(self, size: int, keep: int):
+        """Replace the receive buffer with a larger one, copying the first keep bytes into it"""
+        rx_buffer = bytearray(size)
+        rx_buffer[:keep] = self._rx_view[:keep]
+        self._rx_view.release()
+        self._rx_buffer = rx_buffer
+        self._rx_view = memoryview(self._rx_buffer)
+
+    def _rx_free_space(self) -> memoryview:
+        """
+        Return the part of the receive buffer after any bytes of an incomplete frame already at
+        the start of the buffer. The buffer is doubled in size if it is full.
+        """
+        if self._rx_len == len(self._rx_buffer):
+            self._grow_rx_buffer(2 * len(self._rx_buffer), self._rx_len)
+        return self._rx_view[self._rx_len:]
+
+    def _keep_incomplete(self, start: int, end: int):
+        """Move the bytes of an incomplete frame from start to end to the start of the buffer"""
+        self._rx_len = end - start
+        self._rx_view[:self._rx_len] = self._rx_view[start:end]
+
+    def _extract_agw(self, end: int) -> list:
+        """
+        Return a list of the complete AGWPE frames, header and data, in the first end bytes of
+        the receive buffer, as byte strings. Each frame is a 36 byte header followed by the
+        number of data bytes given in the header, so a single receive may contain several frames.
+        Bytes of an incomplete frame are kept at the start of the receive buffer until the rest
+        of the frame arrives.
+        If a header gives a data length larger than AGW_MAX_DATA_LEN, the received data is no
+        longer aligned with the AGWPE frames. The rest of the buffer is discarded and the
+        connection is closed, so that receive_packets reconnects to the TNC.
+        """
+        # bind to locals, as these are used for every frame
+        buffer = self._rx_buffer
+        view = self._rx_view
+        unpack_data_len = AGW_DATA_LEN.unpack_from
+        frames = []
+        append = frames.append
+        start = 0
+        while end - start >= AGW_HEADER_LENGTH:
+            data_len, = unpack_data_len(buffer, start)
+            if data_len > AGW_MAX_DATA_LEN:
+                logging.error("Received AGWPE frame with invalid data length %d, "
+                              "reconnecting to TNC", data_len)
+                self._rx_len = 0
+                self.transport.close()
+                return frames
+            frame_end = start + AGW_HEADER_LENGTH + data_len
+            if frame_end > end:
+                break
+            append(bytes(view[start:frame_end]))
+            start = frame_end
+        self._keep_incomplete(start, end)
+        return frames
+
+    def _extract_kiss(self, end: int) -> list:
+        """
+        Return a list of the complete KISS frames in the first end bytes of the receive buffer.
+        Bytes of an incomplete frame are kept at the start of the receive buffer until the rest
+        of the frame arrives.
+        If an incomplete frame is longer than KISS_MAX_FRAME_LEN, its bytes are discarded, along
+        with the rest of the frame up to the next frame delimiter.
+        """
+        # sometimes, a KISS interface will pass multiple packets. Walk the buffer from one frame
+        # delimiter to the next, skipping empty frames between consecutive delimiters.
+        # Everything after the last delimiter is incomplete. Bytes kept from previous reads
+        # contain no delimiter, so the search starts after them
+        buffer = self._rx_buffer
+        view = self._rx_view
+        frames = []
+        start = 0
+        fend = buffer.find(b'\xc0', self._rx_len, end)
+        while fend >= 0:
+            if self._kiss_discard:
+                # the start of this frame was discarded
+                self._kiss_discard = False
+            elif fend > start:
+                frames.append(bytes(view[start:fend]))
+            start = fend + 1
+            fend = buffer.find(b'\xc0', start, end)
+        if end - start > KISS_MAX_FRAME_LEN:
+            if not self._kiss_discard:
+                logging.error("Received more than %d bytes without a KISS frame delimiter, "
+                              "discarding data until the next frame", KISS_MAX_FRAME_LEN)
+                self._kiss_discard = True
+            self._rx_len = 0
+            return frames
+        # move the start of the next frame to the start of the buffer
+        self._keep_incomplete(start, end)
+        return frames
+
+    def _rx_updated(self, nbytes: int):
+        """Add the complete packets in the receive buffer to the queue after nbytes are received"""
+        end = self._rx_len + nbytes
+        if self.kiss_mode:
+            packets = self._extract_kiss(end)
+        else:
+            packets = self._extract_agw(end)
+        if not packets:
+            return
+        dropped = len(self.packet_queue) + len(packets) - PACKET_QUEUE_LENGTH
+        if dropped > 0:
+            logging.warning("Packet queue is full, dropping %d oldest packets", dropped)
+        # all packets from one read are queued together, with a single wakeup of the consumer
+        self.packet_queue.extend(packets)
+        self.packets_ready.set()
+        logging.debug("Received packet, total %d in queue", len(self.packet_queue))
+
     async def receive_packets(self):
         """
-        Continually receive packets from the AGWPE API and append them to the packet list
+        Continually receive packets from the TNC and append them to the packet queue
         as byte strings.
         """
-        # set the socket to non-blocking. If this is not set manually in Python 3.7, sock_recv will
-        # block other tasks. It is only set once we begin receiving packets for metric calculations,
-        # because the earlier socket operations to create a connection to the TNC can run
-        # synchronously. Therefore, there is no reason to set nonblocking early
-        # and create extra complexity.
-        self.client_socket.setblocking(False)
         # loop to listen for packets sent from the TNC and add them to the queue for metrics
-        # processing
+        # processing. The connection to the TNC is made synchronously, then the connected socket
+        # is handed to the event loop, which reads into the receive buffer as data arrives.
         while True:
-            packet_bytes: bytes = b""
-            bytes_recv: int = 0
-            while bytes_recv < 36:
-                try:
-                    chunk = await self.loop.sock_recv(self.client_socket, 4096)
-                    if chunk == b'':
-                        raise ConnectionResetError("Socket connection broken")
-                except ConnectionResetError:
-                    logging.error("Connection to TNC was reset")
-                    self.client_socket.close()
-                    # TODO: can we force any metrics in queue to be exported once the socket closes, so they don't wait
-                    #  in limbo until the sock_recv coroutine runs again?
-                    # remake client socket
-                    self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                    if self.kiss_mode:
-                        self.connect_kiss(self.tnc_host, self.tnc_port)
-                    else:
-                        self.connect_agw(self.tnc_host, self.tnc_port)
-                    # set socket to nonblocking to prevent blocking async tasks
-                    self.client_socket.setblocking(False)
-                    continue
-                else:
-                    packet_bytes += chunk
-                    bytes_recv += len(chunk)
-            if self.kiss_mode:
-                # sometimes, a KISS interface will pass multiple packets. Split by frame delimiter
-                # and add each to the queue
-                split_packets = packet_bytes.split(b'\xc0')
-                for p in split_packets:
-                    if len(p) > 0:
-                        await self.packet_queue.put(p)
-            else:
-                await self.packet_queue.put(packet_bytes)
-            logging.debug(f"Received packet, total {self.packet_queue.qsize()} in queue")
+            # the socket must be non-blocking to be used by the event loop
+            self.client_socket.setblocking(False)
+            protocol = TNCProtocol(self)
+            await self.loop.create_connection(lambda: protocol, sock=self.client_socket)
+            await protocol.connection_closed
+            logging.error("Connection to TNC was reset")
+            # TODO: can we force any metrics in queue to be exported once the socket closes, so they don't wait
+            #  in limbo until the connection is made again?
+            self.reconnect()
+
+
+class TNCProtocol(asyncio.BufferedProtocol):
+    """
+    Protocol receiving data from the TNC directly into the listener's receive buffer, which
+    passes complete packets on to the listener's packet queue.
+    """
+    def __init__(self, listener: Listener):
+        self.listener = listener
+        # future that is completed when the connection to the TNC is closed
+        self.connection_closed = listener.loop.create_future()
+
+    def connection_made(self, transport: asyncio.Transport):
+        # set the listener's transport here rather than when create_connection returns, so it
+        # is set before any data is received
+        self.listener.transport = transport
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.listener._rx_free_space()
+
+    def buffer_updated(self, nbytes: int):
+        self.listener._rx_updated(nbytes)
+
+    def connection_lost(self, exc):
+        if not self.connection_closed.done():
+            self.connection_closed.set_result(exc)
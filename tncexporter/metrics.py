@@ -4,7 +4,7 @@ This module defines the prometheus metrics to be exported.
 All metrics ending with RECENT record a total over the time span set in the "summary_interval"
 parameter of tncexporter.
 """
-from aioprometheus import Counter, Gauge, Summary, Histogram
+from aioprometheus import Counter, Gauge, Histogram
 
 # Metrics tracking counts of frames received/decoded or transmitted
 # PACKET_RX labels:
@@ -24,14 +24,17 @@ TX_PACKET_SIZE = Histogram("tnc_tx_packet_size",
                            "Length in bytes of data field in transmitted packets",
                            buckets=[0, 50, 100, 150, 200, 250, 300, 350])
 
-# Summary metrics tracking distances of received frames. Only calculated for frames that report
+# Histogram metrics tracking distances of received frames. Only calculated for frames that report
 # position data (APRS). Not currently used in dashboard
-PACKET_DISTANCE = Summary("tnc_packet_distance",
-                          "Distance in meters of received position packets from TNC "
-                          "(digipeated and simplex)")
-RF_PACKET_DISTANCE = Summary("tnc_rf_packet_distance",
-                             "Distance in meters of received position packets from TNC "
-                             "(simplex only)")
+DISTANCE_BUCKETS = [1e3, 5e3, 1e4, 5e4, 1e5, 5e5, 1e6, 5e6]
+PACKET_DISTANCE = Histogram("tnc_packet_distance",
+                            "Distance in meters of received position packets from TNC "
+                            "(digipeated and simplex)",
+                            buckets=DISTANCE_BUCKETS)
+RF_PACKET_DISTANCE = Histogram("tnc_rf_packet_distance",
+                               "Distance in meters of received position packets from TNC "
+                               "(simplex only)",
+                               buckets=DISTANCE_BUCKETS)
 
 # Aggregate metrics, calculated from all packets collected across the interval
 # defined by update_interval
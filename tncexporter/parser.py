@@ -4,25 +4,115 @@ Parser functions to extract relevant data from AGW or KISS format packets
 import datetime
 import logging
 import re
+import struct
+import sys
 from math import asin, cos, sin, sqrt, radians
 from typing import Tuple
 
+# Header at the start of every AGWPE frame: port, data kind, PID, callsign from, callsign to,
+# length of the data following the header and a user field, with reserved bytes skipped.
+# Callsigns are left-justified and padded with nulls
+AGW_HEADER = struct.Struct('<B3xBxBx10s10sII')
+
+# Regular expressions used when parsing every packet are compiled once at import. They match
+# bytes, so that the data field of a packet doesn't have to be decoded to be searched
+# latitude and longitude of a plaintext APRS position report, e.g. 4037.97N/11159.06W
+LATLON_REGEX = re.compile(rb"([0-9]{4}\.[0-9]{2})(?:[0-9]|,){0,5}([NS]).{0,2}"
+                          rb"([01][0-9]{4}\.[0-9]{2})(?:[0-9]|,){0,5}([EW])")
+# list of hops in the AGW monitor header, e.g. "Via SHEPRD,WIDE1,WIDE2-1 <"
+VIA_REGEX = re.compile(rb"Via (.*?) <")
+# non-WIDE path types that don't represent hops through a digipeater
+PATH_TYPES = frozenset(('RELAY', 'ECHO', 'TRACE', 'GATE', 'BEACON', 'ARISS', 'RFONLY', 'NOGATE'))
+# str.translate table replacing the separators between the addresses of a decoded KISS address
+# field, which are the shifted SSID bytes of each address, with a single character to split on
+KISS_PATH_SPLIT = str.maketrans('pqrstuwz', '\x01' * 8)
+
+# APRS data type identifier bytes of uncompressed position reports, mapped to the offset of the
+# latitude from the identifier. Reports with a timestamp have 7 characters before the latitude.
+POSITION_OFFSETS = {ord('!'): 1, ord('='): 1, ord('/'): 8, ord('@'): 8}
+
+# ASCII digits, for checking single bytes of the data field
+DIGITS = b'0123456789'
+
+# bytes.translate table shifting every byte right one bit, to decode AX.25 address fields
+AX25_SHIFT_TABLE = bytes(b >> 1 for b in range(256))
+
+
+def _is_wide(hop: str, separator: str = '-') -> bool:
+    """
+    Check whether a hop is a WIDE path like WIDE, WIDE1 or WIDE2-1, which doesn't represent a
+    hop through a digipeater.
+
+    :param hop: hop from the path of a packet
+    :param separator: character between the two numbers of a WIDEn-N path
+    """
+    if not hop.startswith('WIDE'):
+        return False
+    length = len(hop)
+    if length == 4:
+        return True
+    if length == 5:
+        return hop[4] in '0123456789'
+    return length == 7 and hop[4] in '0123456789' and hop[5] == separator \
+        and hop[6] in '0123456789'
+
+
+# methods PacketInfo.distance_from can calculate distances with
+DISTANCE_METHODS = ('haversine', 'equirectangular')
+
+
+class TncPos:
+    """
+    Fixed position, such as the location of the TNC, that distances to packets are calculated
+    from. The position is converted to radians, and the cosine of its latitude calculated, once
+    here rather than for every packet.
+    """
+
+    __slots__ = ('lat_lon', 'lat_rad', 'lon_rad', 'cos_lat')
+
+    def __init__(self, lat: float, lon: float):
+        self.lat_lon: tuple = (lat, lon)  # latitude and longitude in decimal degrees
+        self.lat_rad: float = radians(lat)
+        self.lon_rad: float = radians(lon)
+        self.cos_lat: float = cos(self.lat_rad)
+
+    def __repr__(self):
+        return f"{self.__class__.__name__}{self.lat_lon!r}"
+
+
 class PacketInfo:
     """Object for parsing and storing AX.25 packet metadata"""
 
+    # attributes are stored in slots rather than a per-instance __dict__, as one PacketInfo is
+    # created for every packet received
+    __slots__ = ('raw_bytes',
+                 'frame_type',
+                 'data_len',
+                 'len_data',
+                 'call_from',
+                 'call_to',
+                 'timestamp_seconds',
+                 'lat_lon',
+                 'lat_rad',
+                 'lon_rad',
+                 'hops_count',
+                 'hops_path')
+
     def __init__(self, packet_bytes: bytes, kiss: bool = False):
         self.raw_bytes: bytes = packet_bytes
-        logging.debug(f"Parsing packet bytes: {repr(self.raw_bytes)}")
+        logging.debug("Parsing packet bytes: %r", self.raw_bytes)
         self.frame_type: str = "Unknown"  # type of frame (U, I, S, T, other)
-        self.data_len: int = 0  # length of data in packet (inclusive of 36 byte header)
+        self.data_len: int = 0  # length of data following the header, as reported by the TNC
+        self.len_data: int = 0  # length of data field, excluding null padding
         self.call_from: str = ""  # originating callsign
         self.call_to: str = ""  # destination callsign
-        # timestamp of when packet was received by TNC
-        self.timestamp: datetime.time = datetime.time(hour=0,
-                                                      minute=0,
-                                                      second=0)
+        # timestamp of when packet was received by TNC, in seconds since midnight
+        self.timestamp_seconds: int = 0
         # tuple containing two floats representing latitude and longitude
         self.lat_lon: tuple = (None, None)
+        # latitude and longitude in radians for distance calculations, if both are known
+        self.lat_rad: float = None
+        self.lon_rad: float = None
         self.hops_count: int = 0  # number of hops. Non-digipeated packets should have 0
         self.hops_path: list[str] = []  # list of hop callsigns
         if kiss:
@@ -30,46 +120,83 @@ class PacketInfo:
         else:
             self._parse_packet_agw(packet_bytes)
 
-    def _parse_coordinates(self, data_field: str):
+    def __repr__(self):
+        attributes = ', '.join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{self.__class__.__name__}({attributes})"
+
+    @property
+    def timestamp(self) -> datetime.time:
+        """Time of day the packet was received by the TNC, created from timestamp_seconds"""
+        minutes, second = divmod(self.timestamp_seconds, 60)
+        hour, minute = divmod(minutes, 60)
+        return datetime.time(hour=hour, minute=minute, second=second)
+
+    @staticmethod
+    def _match_fixed_position(info_field: bytes):
+        """
+        Match an uncompressed APRS position report at its fixed location in the information
+        field, e.g. !4037.97N/11159.06W#. This avoids running the latitude/longitude regex on
+        most position packets.
+        :param info_field: Information field of APRS packet
+        :returns: tuple of raw latitude, N/S, raw longitude and E/W byte strings, or None if the
+        information field does not start with a standard position report
+        """
+        try:
+            start = POSITION_OFFSETS[info_field[0]]
+        except (IndexError, KeyError):
+            return None
+        # latitude ddmm.hhN, symbol table identifier, longitude dddmm.hhW
+        position = info_field[start:start + 18]
+        if len(position) == 18 \
+                and position[0:4].isdigit() and position[4] == 0x2E and position[5:7].isdigit() \
+                and position[7] in b'NS' \
+                and position[9:14].isdigit() and position[14] == 0x2E \
+                and position[15:17].isdigit() and position[17] in b'EW':
+            return position[0:7], position[7:8], position[9:17], position[17:18]
+        return None
+
+    def _parse_coordinates(self, data_field: bytes):
         """
         Parses latitude and longitude coordinates stored as plaintext in the information field of an
         APRS packet. Does not parse compressed format or Mic-E format position reports
-        :param data_field: Data/information field of APRS packet
+        :param data_field: Information field of APRS packet
         """
         latitude = None
         longitude = None
         try:
-            # parse latitude and longitude from position packets
-            latlon_regex = r"([0-9][0-9][0-9][0-9]\.[0-9][0-9])(?:[0-9]|,){0,5}(N|S).{0,2}" \
-                           r"([0-1][0-9][0-9][0-9][0-9]\.[0-9][0-9])(?:[0-9]|,){0,5}(E|W)"
-            latlon_match = re.search(latlon_regex, data_field)
-            if latlon_match is not None:
-                logging.debug(f"latlon regex results: {latlon_match.groups()}")
-                raw_lat = latlon_match[1]
-                lat_direction = latlon_match[2]
-                raw_lon = latlon_match[3]
-                lon_direction = latlon_match[4]
-                if lat_direction == 'N':
-                    latitude = round(float(raw_lat) / 100, 4)
-                elif lat_direction == 'S':
-                    latitude = round(-float(raw_lat) / 100, 4)
-                else:
-                    latitude = None
-                if lon_direction == 'E':
-                    longitude = round(float(raw_lon) / 100, 4)
-                elif lon_direction == 'W':
-                    longitude = round(-float(raw_lon) / 100, 4)
-                else:
-                    longitude = None
+            # parse latitude and longitude from position packets, trying the standard position
+            # report format before searching the whole data field
+            position = self._match_fixed_position(data_field)
+            if position is None:
+                latlon_match = LATLON_REGEX.search(data_field)
+                if latlon_match is not None:
+                    position = latlon_match.groups()
+                    logging.debug("latlon regex results: %s", position)
+            if position is not None:
+                # positions are degrees and minutes to two decimal places, ddmm.hh for latitude
+                # and dddmm.hh for longitude. Convert them to decimal degrees
+                raw_lat, lat_direction, raw_lon, lon_direction = position
+                latitude = int(raw_lat[0:2]) \
+                    + (int(raw_lat[2:4]) * 100 + int(raw_lat[5:7])) / 6000
+                longitude = int(raw_lon[0:3]) \
+                    + (int(raw_lon[3:5]) * 100 + int(raw_lon[6:8])) / 6000
+                if lat_direction == b'S':
+                    latitude = -latitude
+                if lon_direction == b'W':
+                    longitude = -longitude
             # TODO: decode position reports from Mic-E and APRS compressed formats
         except (IndexError, ValueError):
             pass
         self.lat_lon = (latitude, longitude)
+        if latitude is not None and longitude is not None:
+            self.lat_rad = radians(latitude)
+            self.lon_rad = radians(longitude)
 
     def haversine_distance(
             self,
             tnc_pos: Tuple[float, float],
-            radius: float = 6371.0e3
+            radius: float = 6371.0e3,
+            method: str = 'haversine'
     ) -> float:
         """
         Calculate the distance between two points on a sphere (e.g. Earth).
@@ -83,79 +210,122 @@ class PacketInfo:
         `Reference <https://en.wikipedia.org/wiki/Haversine_formula>`_
         :param tnc_pos: a tuple defining (lat, lon) in decimal degrees
         :param radius: radius of sphere in meters.
+        :param method: 'haversine', or 'equirectangular' to use the faster equirectangular
+         approximation instead of the haversine formula
         :returns: distance between two points in meters.
         :rtype: float
         """
-        lat1, lon1, lat2, lon2 = [radians(x) for x in (*self.lat_lon, *tnc_pos)]
+        distance = self.distance_from(TncPos(*tnc_pos), radius, method)
+        logging.debug("Calculated distance between %s and %s = %.4f",
+                      self.lat_lon, tnc_pos, distance)
+        return distance
 
+    def distance_from(
+            self,
+            tnc_pos: TncPos,
+            radius: float = 6371.0e3,
+            method: str = 'haversine'
+    ) -> float:
+        """
+        Calculate the distance between the packet's position and a TncPos, using the radians
+        calculated when the packet was parsed and the values precomputed by TncPos. Only one
+        cosine is needed per packet. See haversine_distance.
+        The packet must have a position, i.e. lat_rad and lon_rad must not be None.
+        :param tnc_pos: a TncPos to calculate the distance from
+        :param radius: radius of sphere in meters.
+        :param method: 'haversine', or 'equirectangular' to use the equirectangular
+         approximation, which is faster and accurate to well under 0.1% at the ranges packets
+         are usually heard over, but the error grows with distance and latitude
+        :returns: distance between the two points in meters.
+        :rtype: float
+        """
+        lat_rad = self.lat_rad
+        if method == 'equirectangular':
+            x = (self.lon_rad - tnc_pos.lon_rad) * cos((lat_rad + tnc_pos.lat_rad) / 2.0)
+            y = lat_rad - tnc_pos.lat_rad
+            return radius * sqrt(x * x + y * y)
+        if method != 'haversine':
+            raise ValueError(f"Unknown distance method: {method}")
         hav = (
-                sin((lat2 - lat1) / 2.0) ** 2
-                + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2.0) ** 2
+                sin((lat_rad - tnc_pos.lat_rad) / 2.0) ** 2
+                + tnc_pos.cos_lat * cos(lat_rad) * sin((self.lon_rad - tnc_pos.lon_rad) / 2.0) ** 2
         )
-        distance = 2 * radius * asin(sqrt(hav))
-        logging.debug(f"Calculated distance between {self.lat_lon} and {tnc_pos} = {distance:.4f}")
-        return distance
+        return 2 * radius * asin(sqrt(hav))
+
+    def _parse_timestamp(self, data_field: bytes):
+        """
+        Find the first timestamp in HH:MM:SS format, such as the one added to the AGW monitor
+        header by the TNC, and store it in self.timestamp_seconds. Candidates are found by
+        searching for colons with bytes.find rather than searching the whole field with a regex.
+        :param data_field: data field of packet
+        """
+        i = data_field.find(b':')
+        while i >= 0:
+            candidate = data_field[i - 2:i + 6] if i >= 2 else b''
+            if len(candidate) == 8 and candidate[5] == 0x3A \
+                    and candidate[0] in b'012' and candidate[1] in DIGITS \
+                    and candidate[3] in b'012345' and candidate[4] in DIGITS \
+                    and candidate[6] in b'012345' and candidate[7] in DIGITS:
+                hour = int(candidate[0:2])
+                # hours from 24 to 29 match the format but aren't a valid time
+                if hour < 24:
+                    self.timestamp_seconds = hour * 3600 + int(candidate[3:5]) * 60 \
+                        + int(candidate[6:8])
+                return
+            i = data_field.find(b':', i + 1)
 
     def _parse_packet_agw(self, raw_packet: bytes):
         """Parse AGW-format packet bytes, create a PacketInfo object
         :param raw_packet: packet bytes
         """
         try:
-            self.frame_type = chr(raw_packet[4]).upper()
-            self.call_from = raw_packet[8:18].strip(b'\x00').decode("ascii", errors="replace")
-            self.call_to = raw_packet[18:28].strip(b'\x00').decode("ascii", errors="replace")
-            data_bytes = raw_packet[36:].strip(b'\x00')
+            # all header fields are unpacked in one call
+            _, data_kind, _, call_from, call_to, self.data_len, _ = \
+                AGW_HEADER.unpack_from(raw_packet)
+            self.frame_type = chr(data_kind).upper()
+            # the originating callsign is a PACKET_RX label, and the same stations are heard
+            # repeatedly, so it is interned to share one string per callsign
+            self.call_from = sys.intern(
+                call_from.rstrip(b'\x00').decode("ascii", errors="replace"))
+            self.call_to = call_to.rstrip(b'\x00').decode("ascii", errors="replace")
+            # the data field follows the header, without its null padding. It is parsed as
+            # bytes, only decoding the parts that are stored as strings
+            data_bytes = raw_packet[AGW_HEADER.size:].strip(b'\x00')
             self.len_data = len(data_bytes)
-            data_string = data_bytes.decode("ascii", errors="replace")
-            logging.debug(f"Parsing data field: {repr(data_string)}")
+            logging.debug("Parsing data field: %r", data_bytes)
+            # the information field follows the first carriage return after the monitor header.
+            # The timestamp and hops are only searched for in the header, and the position only
+            # in the information field, so each part of the data field is scanned once
+            header, _, info_field = data_bytes.partition(b'\r')
             # parse timestamp
-            time_match = re.search("[0-2][0-9]:[0-5][0-9]:[0-5][0-9]", data_string)
-            if time_match is not None:
-                try:
-                    raw_hour = time_match.group()[0:2]
-                    raw_min = time_match.group()[3:5]
-                    raw_sec = time_match.group()[6:8]
-                    self.timestamp = datetime.time(hour=int(raw_hour),
-                                                   minute=int(raw_min),
-                                                   second=int(raw_sec))
-                except TypeError:
-                    pass
-            try:
-                # Parse list of hops
-                # This won't parse the hops list in headers that UI-View creates, and possibly
-                # some other non-standard header formats as well.
-                hops_string = re.findall("Via (.*?) <", data_string)[0]
-                # tuple of non-WIDE path types that don't represent hops through a digipeater
-                path_types = ('RELAY',
-                              'ECHO',
-                              'TRACE',
-                              'GATE',
-                              'BEACON',
-                              'ARISS',
-                              'RFONLY',
-                              'NOGATE')
-                # regex matching all WIDE paths like WIDE1, WIDE 1-1, WIDE2-2 etc
-                wide_regex = "^WIDE(\b|([0-9]-[0-9])|[0-9])"
+            self._parse_timestamp(header)
+            # Parse list of hops
+            # This won't parse the hops list in headers that UI-View creates, and possibly
+            # some other non-standard header formats as well.
+            via_match = VIA_REGEX.search(header)
+            if via_match is not None:
                 # determine if the packet was digipeated by making a list of hops that dont
                 # match known "path" hop types
-                self.hops_path = [h for h in hops_string.split(',') if h not in path_types
-                                  and re.fullmatch(wide_regex, h) is None]
+                hops = via_match.group(1).decode("ascii", errors="replace").split(',')
+                self.hops_path = [h for h in hops if h not in PATH_TYPES and not _is_wide(h)]
                 self.hops_count = len(self.hops_path)
-            except IndexError:
-                pass
-            self._parse_coordinates(data_string)
-        except IndexError:
+            self._parse_coordinates(info_field)
+        except (IndexError, struct.error):
             logging.error("Packet less than expected length")
 
     def _parse_packet_kiss(self, raw_packet: bytes):
         """Parse KISS-format packet bytes"""
         # TODO: finish KISS parsing
         try:
-            if hex(raw_packet[0]) != "0x0":
+            if raw_packet[0] != 0x00:
                 raise ValueError('Not a data frame?')
 
-            self.call_to = ''.join([chr(b >> 1) for b in raw_packet[1:7]]).strip()
-            self.call_from = ''.join([chr(b >> 1) for b in raw_packet[8:14]]).strip()
+            # AX.25 address characters are shifted left one bit. Shift them back with a
+            # translate table, then decode the callsign in one call. Callsigns are
+            # left-justified and padded with spaces, so only trailing padding is stripped
+            self.call_to = raw_packet[1:7].translate(AX25_SHIFT_TABLE).decode("ascii").rstrip()
+            self.call_from = sys.intern(
+                raw_packet[8:14].translate(AX25_SHIFT_TABLE).decode("ascii").rstrip())
 
             try:
                 split_packet = raw_packet[15:].split(b'\x03\xf0')
@@ -166,28 +336,18 @@ class PacketInfo:
                 pass
             else:
                 self.frame_type = 'U'
-                path_string = ''.join([chr(b >> 1) for b in path_bytes])
-                path_types = ('RELAY',
-                              'ECHO',
-                              'TRACE',
-                              'GATE',
-                              'BEACON',
-                              'ARISS',
-                              'RFONLY',
-                              'NOGATE')
-                # regex matching all WIDE paths like WIDE1, WIDE 1 1, WIDE2-2 etc
-                wide_regex = "^WIDE(\b|([0-9] [0-9])|[0-9])"
+                path_string = path_bytes.translate(AX25_SHIFT_TABLE).decode("ascii")
                 # Parse hops list
                 # This won't parse the hops list in headers that UI-View creates, and possibly
                 # some other non-standard header formats as well
-                self.hops_path = [h.strip() for h in re.split('[pqrstuwz]', path_string)
-                                  if len(h.strip()) > 0
-                                  and h.strip() not in path_types
-                                  and re.fullmatch(wide_regex, h.strip()) is None]
+                hops = (h.strip() for h in path_string.translate(KISS_PATH_SPLIT).split('\x01'))
+                self.hops_path = [h for h in hops
+                                  if len(h) > 0
+                                  and h not in PATH_TYPES
+                                  and not _is_wide(h, ' ')]
                 self.hops_count = len(self.hops_path)
-                data_string = data_bytes.decode("ascii", errors="replace")
-                logging.debug(f"Parsing data field: {repr(data_string)}")
-                self._parse_coordinates(data_string)
+                logging.debug("Parsing data field: %r", data_bytes)
+                self._parse_coordinates(data_bytes)
                 self.len_data = len(data_bytes)
         except IndexError:
             logging.error("Packet less than expected length")